@@ -6,17 +6,30 @@
 #
 ##
 import os
+import asyncio
 import logging
-import glob
 import stat
-import xml.etree.ElementTree
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from edk2toolext.environment.plugintypes.uefi_build_plugin import IUefiBuildPlugin
 from edk2toolext import edk2_logging
 import edk2toollib.windows.locate_tools as locate_tools
-from edk2toolext.environment import shell_environment
 from edk2toollib.utility_functions import RunCmd
 from edk2toollib.utility_functions import GetHostInfo
 from textwrap import dedent
+from xml.etree.ElementTree import ParseError
+
+try:
+    # lxml's libxml2 parser is much faster on large result files and can skip
+    # uninteresting elements while parsing.
+    from lxml import etree
+    _RESULT_ITERPARSE_ARGS = {'tag': ('testcase', 'failure')}
+    _RESULT_PARSE_ERRORS = (ParseError, etree.XMLSyntaxError)
+except ImportError:
+    import xml.etree.ElementTree as etree
+    _RESULT_ITERPARSE_ARGS = {}
+    _RESULT_PARSE_ERRORS = (ParseError,)
 
 
 class HostBasedUnitTestRunner(IUefiBuildPlugin):
@@ -36,54 +49,35 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
         EXPECTS:
         - Build Var 'CI_BUILD_TYPE' - If not set to 'host_unit_test', will not do anything.
 
-        UPDATES:
-        - Shell Var 'CMOCKA_XML_FILE'
+        Tests are run concurrently. 'CMOCKA_MESSAGE_OUTPUT', 'CMOCKA_XML_FILE' and
+        'GTEST_OUTPUT' are passed to each test through its own process environment;
+        the shell environment is not modified.
         '''
         ci_type = thebuilder.env.GetValue('CI_BUILD_TYPE')
         if ci_type != 'host_unit_test':
             return 0
 
-        shell_env = shell_environment.GetEnvironment()
         logging.log(edk2_logging.get_section_level(),
                     "Run Host based Unit Tests")
         path = thebuilder.env.GetValue("BUILD_OUTPUT_BASE")
 
         failure_count = 0
 
+        base_env = os.environ.copy()
         # Set up the reporting type for Cmocka.
-        shell_env.set_shell_var('CMOCKA_MESSAGE_OUTPUT', 'xml')
+        base_env['CMOCKA_MESSAGE_OUTPUT'] = 'xml'
+
+        host_os = GetHostInfo().os.upper()
+        if host_os not in ("LINUX", "WINDOWS"):
+            raise NotImplementedError("Unsupported Operating System")
 
         for arch in thebuilder.env.GetValue("TARGET_ARCH").split():
             logging.log(edk2_logging.get_subsection_level(),
                         "Testing for architecture: " + arch)
             cp = os.path.join(path, arch)
 
-            # If any old results XML files exist, clean them up.
-            for old_result in glob.iglob(os.path.join(cp, "*.result.xml")):
-                os.remove(old_result)
-
-            # Find and Run any Host Tests
-            if GetHostInfo().os.upper() == "LINUX":
-                testList = glob.glob(os.path.join(cp, "*Test*"))
-                for a in testList[:]:
-                    p = os.path.join(cp, a)
-                    # It must be a file
-                    if not os.path.isfile(p):
-                        testList.remove(a)
-                        logging.debug(f"Remove directory file: {p}")
-                        continue
-                    # It must be executable
-                    if os.stat(p).st_mode & (stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH) == 0:
-                        testList.remove(a)
-                        logging.debug(f"Remove non-executable file: {p}")
-                        continue
-
-                    logging.info(f"Test file found: {p}")
-
-            elif GetHostInfo().os.upper() == "WINDOWS":
-                testList = glob.glob(os.path.join(cp, "*Test*.exe"))
-            else:
-                raise NotImplementedError("Unsupported Operating System")
+            # Clean up any old results and find the Host Tests
+            testList = self._find_tests(cp, host_os)
 
             if not testList:
                 logging.warning(dedent("""
@@ -97,36 +91,7 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
                     """).strip())
                 return 0
 
-            for test in testList:
-                # Configure output name if test uses cmocka.
-                shell_env.set_shell_var(
-                    'CMOCKA_XML_FILE', test + ".CMOCKA.%g." + arch + ".result.xml")
-                # Configure output name if test uses gtest.
-                shell_env.set_shell_var(
-                    'GTEST_OUTPUT', "xml:" + test + ".GTEST." + arch + ".result.xml")
-
-                # Run the test.
-                ret = RunCmd('"' + test + '"', "", workingdir=cp)
-                if ret != 0:
-                    logging.error("UnitTest Execution Error: " +
-                                  os.path.basename(test))
-                else:
-                    logging.info("UnitTest Completed: " +
-                                 os.path.basename(test))
-                    file_match_pattern = test + ".*." + arch + ".result.xml"
-                    xml_results_list = glob.glob(file_match_pattern)
-                    for xml_result_file in xml_results_list:
-                        root = xml.etree.ElementTree.parse(
-                            xml_result_file).getroot()
-                        for suite in root:
-                            for case in suite:
-                                for result in case:
-                                    if result.tag == 'failure':
-                                        logging.warning(
-                                            "%s Test Failed" % os.path.basename(test))
-                                        logging.warning(
-                                            "  %s - %s" % (case.attrib['name'], result.text))
-                                        failure_count += 1
+            failure_count += asyncio.run(self._run_all(testList, arch, cp, base_env))
 
             if thebuilder.env.GetValue("CODE_COVERAGE") != "FALSE":
                 if thebuilder.env.GetValue("TOOL_CHAIN_TAG") == "GCC5":
@@ -142,21 +107,180 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
 
         return failure_count
 
+    def _find_tests(self, cp, host_os):
+        '''
+        Remove any old results XML files from the output directory and return the
+        paths of the host-based unit tests found in it.
+        '''
+        testList = []
+        if not os.path.isdir(cp):
+            return testList
+
+        # Single pass over the directory: clean up old results XML files and
+        # collect the tests.
+        with os.scandir(cp) as it:
+            for entry in it:
+                if entry.name.endswith(".result.xml"):
+                    os.remove(entry.path)
+                    continue
+
+                if host_os == "LINUX":
+                    if "Test" not in entry.name:
+                        continue
+                    # It must be a file
+                    if not entry.is_file():
+                        logging.debug(f"Remove directory file: {entry.path}")
+                        continue
+                    # It must be executable
+                    if entry.stat().st_mode & (stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH) == 0:
+                        logging.debug(f"Remove non-executable file: {entry.path}")
+                        continue
+
+                    logging.info(f"Test file found: {entry.path}")
+                    testList.append(entry.path)
+                else:
+                    # Match the case-insensitive "*Test*.exe" glob used on Windows.
+                    name = entry.name.lower()
+                    if "test" in name and name.endswith(".exe") and entry.is_file():
+                        testList.append(entry.path)
+
+        return testList
+
+    async def _run_all(self, testList, arch, cp, base_env):
+        '''
+        Run the tests concurrently, at most cpu_count - 2 at a time. The results of a
+        finished test are parsed while the other tests keep running. Returns the
+        total number of failures found.
+
+        The results are parsed whatever the exit code is: CMocka based tests exit
+        with 0 even when a test case fails.
+        '''
+        sem = asyncio.Semaphore(max(1, (os.cpu_count() or 1) - 2))
+        loop = asyncio.get_running_loop()
+
+        async def run_one(test):
+            async with sem:
+                return test, await self._run_one_test(test, arch, cp, base_env)
+
+        failure_count = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as parse_pool:
+            parse_futures = []
+            for completed in asyncio.as_completed([run_one(test) for test in testList]):
+                test, _ = await completed
+                parse_futures.append(loop.run_in_executor(
+                    parse_pool, self._parse_result_xmls, test, arch, cp))
+            for count in await asyncio.gather(*parse_futures):
+                failure_count += count
+
+        return failure_count
+
+    async def _run_one_test(self, test, arch, cp, base_env):
+        '''
+        Run a single host-based unit test and return its exit code.
+
+        The result file names are added to a copy of base_env so that tests can
+        safely run in parallel.
+        '''
+        test_base = os.path.basename(test)
+
+        env = base_env.copy()
+        # Configure output name if test uses cmocka.
+        env['CMOCKA_XML_FILE'] = f"{test}.CMOCKA.%g.{arch}.result.xml"
+        # Configure output name if test uses gtest.
+        env['GTEST_OUTPUT'] = f"xml:{test}.GTEST.{arch}.result.xml"
+
+        # Run the test.
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                test, cwd=cp, env=env,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            out, _ = await proc.communicate()
+            ret = proc.returncode
+        except OSError as e:
+            out = str(e).encode()
+            ret = 1
+
+        # Log the output in one block so that it is not interleaved with other tests.
+        output = out.decode(errors="replace").rstrip()
+        if output:
+            logging.info(output)
+
+        if ret != 0:
+            logging.error(f"UnitTest Execution Error: {test_base}")
+        else:
+            logging.info(f"UnitTest Completed: {test_base}")
+
+        return ret
+
+    def _parse_result_xmls(self, test, arch, cp):
+        '''
+        Parse the XML results written by a test. Logs each failure and returns the
+        number of failures found. A results file that cannot be parsed, e.g. one left
+        truncated by a crashed test, is counted as one failure.
+        '''
+        test_base = os.path.basename(test)
+        failure_count = 0
+
+        # The GTest results file name is fully known. CMocka expands %g to the group
+        # name, so only those files need to be looked up. Old results were removed
+        # before the run, so any match belongs to this run.
+        xml_results_list = []
+        gtest_xml = f"{test}.GTEST.{arch}.result.xml"
+        if os.path.isfile(gtest_xml):
+            xml_results_list.append(gtest_xml)
+        cmocka_prefix = f"{test_base}.CMOCKA."
+        suffix = f".{arch}.result.xml"
+        with os.scandir(cp) as it:
+            xml_results_list += [entry.path for entry in it
+                                 if entry.name.startswith(cmocka_prefix) and entry.name.endswith(suffix)]
+        for xml_result_file in xml_results_list:
+            # Stream the results so large XML files are never fully loaded. Failures
+            # are reported as soon as they are parsed and every element is released
+            # once it has been handled.
+            case_name = None
+            try:
+                for event, elem in etree.iterparse(
+                        xml_result_file, events=('start', 'end'),
+                        **_RESULT_ITERPARSE_ARGS):
+                    if event == 'start':
+                        if elem.tag == 'testcase':
+                            case_name = elem.attrib.get('name')
+                    elif elem.tag == 'failure':
+                        logging.warning(
+                            "%s Test Failed" % test_base)
+                        logging.warning(
+                            "  %s - %s" % (case_name, elem.text))
+                        failure_count += 1
+                        elem.clear()
+                    elif elem.tag == 'testcase':
+                        case_name = None
+                        elem.clear()
+            except _RESULT_PARSE_ERRORS as e:
+                logging.error(
+                    "%s Test Results Invalid: %s - %s" % (test_base, os.path.basename(xml_result_file), e))
+                failure_count += 1
+
+        return failure_count
+
     def gen_code_coverage_gcc(self, thebuilder):
         logging.info("Generating UnitTest code coverage")
 
         buildOutputBase = thebuilder.env.GetValue("BUILD_OUTPUT_BASE")
         workspace = thebuilder.env.GetValue("WORKSPACE")
 
-        # Generate base code coverage for all source files
-        ret = RunCmd("lcov", f"--no-external --capture --initial --directory {buildOutputBase} --output-file {buildOutputBase}/cov-base.info --rc lcov_branch_coverage=1")
-        if ret != 0:
+        # The initial (base) and the runtime capture are independent scans of the
+        # build output, so run them at the same time.
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # Generate base code coverage for all source files
+            base = pool.submit(RunCmd, "lcov", f"--no-external --capture --initial --directory {buildOutputBase} --output-file {buildOutputBase}/cov-base.info --rc lcov_branch_coverage=1")
+            # Coverage data for tested files only
+            test = pool.submit(RunCmd, "lcov", f"--capture --directory {buildOutputBase}/ --output-file {buildOutputBase}/coverage-test.info --rc lcov_branch_coverage=1")
+
+        if base.result() != 0:
             logging.error("UnitTest Coverage: Failed to build initial coverage data.")
             return 1
 
-        # Coverage data for tested files only
-        ret = RunCmd("lcov", f"--capture --directory {buildOutputBase}/ --output-file {buildOutputBase}/coverage-test.info --rc lcov_branch_coverage=1")
-        if ret != 0:
+        if test.result() != 0:
             logging.error("UnitTest Coverage: Failed to build coverage data for tested files.")
             return 1
 
@@ -179,11 +303,25 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
             return 1
 
         # Generate all coverage file
-        testCoverageList = glob.glob (f"{workspace}/Build/**/total-coverage.info", recursive=True)
+        testCoverageList = self._find_files_named(f"{workspace}/Build", "total-coverage.info")
 
-        coverageFile = ""
+        # Skip duplicates reached through links and files left over from older runs
+        # that were not cleaned from the Build directory.
+        seen = set()
+        freshCoverageList = []
+        cutoff = time.time() - 24 * 60 * 60
         for testCoverage in testCoverageList:
-            coverageFile += " --add-tracefile " + testCoverage
+            realPath = os.path.realpath(testCoverage)
+            if realPath in seen:
+                continue
+            seen.add(realPath)
+            if os.path.getmtime(testCoverage) < cutoff:
+                logging.info(f"UnitTest Coverage: Skipping stale coverage file {testCoverage}")
+                continue
+            freshCoverageList.append(testCoverage)
+        testCoverageList = freshCoverageList
+
+        coverageFile = " ".join(f"--add-tracefile {testCoverage}" for testCoverage in testCoverageList)
         ret = RunCmd("lcov", f"{coverageFile} --output-file {workspace}/Build/all-coverage.info --rc lcov_branch_coverage=1")
         if ret != 0:
             logging.error("UnitTest Coverage: Failed generate all coverage file.")
@@ -193,37 +331,70 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
         if os.path.isfile(f"{workspace}/Build/coverage.xml"):
             os.remove(f"{workspace}/Build/coverage.xml")
         ret = RunCmd("lcov_cobertura",f"{workspace}/Build/all-coverage.info --excludes ^.*UnitTest\|^.*MU\|^.*Mock\|^.*DEBUG -o {workspace}/Build/coverage.xml")
+        if ret != 0:
+            logging.error("UnitTest Coverage: Failed to generate all coverage XML.")
+            return 1
 
         return 0
 
 
+    def _find_files_named(self, root, name):
+        '''
+        Return the paths of all files called name under root. Only directories are
+        descended into and names are compared exactly, which is much cheaper than a
+        recursive glob over a large Build tree.
+        '''
+        found = []
+        stack = [root]
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name == name:
+                        found.append(entry.path)
+        return found
+
     def gen_code_coverage_msvc(self, thebuilder):
         logging.info("Generating UnitTest code coverage")
 
 
         buildOutputBase = thebuilder.env.GetValue("BUILD_OUTPUT_BASE")
-        testList = glob.glob(os.path.join(buildOutputBase, "**","*Test*.exe"), recursive=True)
         workspace = thebuilder.env.GetValue("WORKSPACE")
         workspace = (workspace + os.sep) if workspace[-1] != os.sep else workspace
         workspaceBuild = os.path.join(workspace, 'Build')
-        # Generate coverage file
-        coverageFile = ""
-        for testFile in testList:
-            ret = RunCmd("OpenCppCoverage", f"--source {workspace} --export_type binary:{testFile}.cov -- {testFile}")
-            if ret != 0:
+
+        # Walk the Build tree once to find both the tests of this package and the
+        # coverage files of all packages.
+        exeList, covList = self._find_coverage_files_msvc(workspaceBuild)
+        packagePrefix = os.path.join(os.path.normcase(os.path.normpath(buildOutputBase)), '')
+        if packagePrefix.startswith(os.path.join(os.path.normcase(os.path.normpath(workspaceBuild)), '')):
+            testList = [exe for exe in exeList if os.path.normcase(exe).startswith(packagePrefix)]
+            # The coverage files of this package are regenerated below.
+            packageCovs = {os.path.normcase(f"{testFile}.cov") for testFile in testList}
+            covList = [cov for cov in covList if os.path.normcase(cov) not in packageCovs]
+            covList += [f"{testFile}.cov" for testFile in testList]
+        else:
+            testList, _ = self._find_coverage_files_msvc(buildOutputBase)
+
+        totalCoverageFile = os.path.join(buildOutputBase, 'coverage.cov')
+        max_workers = max(1, (os.cpu_count() or 1) - 2)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Generate coverage file for each test
+            results = pool.map(
+                lambda testFile: self._collect_coverage_msvc(testFile, workspace), testList)
+            if any(ret != 0 for ret in results):
                 logging.error("UnitTest Coverage: Failed to collect coverage data.")
                 return 1
 
-            coverageFile  = f" --input_coverage={testFile}.cov"
-            totalCoverageFile = os.path.join(buildOutputBase, 'coverage.cov')
+            coverageList = [f"{testFile}.cov" for testFile in testList]
             if os.path.isfile(totalCoverageFile):
-                coverageFile += f" --input_coverage={totalCoverageFile}"
-            ret = RunCmd(
-                "OpenCppCoverage",
-                f"--export_type binary:{totalCoverageFile} " +
-                f"--working_dir={workspaceBuild} " +
-                f"{coverageFile}"
-                )
+                coverageList.append(totalCoverageFile)
+            ret = self._merge_coverage_msvc(pool, coverageList, totalCoverageFile, workspaceBuild)
             if ret != 0:
                 logging.error("UnitTest Coverage: Failed to collect coverage data.")
                 return 1
@@ -231,40 +402,120 @@ class HostBasedUnitTestRunner(IUefiBuildPlugin):
         # Generate and XML file if requested.by each package
         ret = RunCmd(
             "OpenCppCoverage",
-            f"--export_type cobertura:{os.path.join(buildOutputBase, 'coverage.xml')} " +
-            f"--working_dir={workspaceBuild} " +
-            f"--input_coverage={totalCoverageFile} "
+            f"--export_type \"cobertura:{os.path.join(buildOutputBase, 'coverage.xml')}\" " +
+            f'"--working_dir={workspaceBuild}" ' +
+            f'"--input_coverage={totalCoverageFile}"'
             )
         if ret != 0:
             logging.error("UnitTest Coverage: Failed to generate cobertura format xml in single package.")
             return 1
 
         # Generate total report XML file for all package
-        testCoverageList = glob.glob(os.path.join(workspace, "Build", "**", "*Test*.exe.cov"), recursive=True)
-        coverageFile = ""
+        testCoverageList = covList
         totalCoverageFile = os.path.join(workspaceBuild, 'coverage.cov')
-        for testCoverage in testCoverageList:
-            coverageFile  = f" --input_coverage={testCoverage}"
-            if os.path.isfile(totalCoverageFile):
-                coverageFile += f" --input_coverage={totalCoverageFile}"
-            ret = RunCmd(
-                "OpenCppCoverage",
-                f"--export_type binary:{totalCoverageFile} " +
-                f"--working_dir={workspaceBuild} " +
-                f"{coverageFile}"
-                )
-            if ret != 0:
-                logging.error("UnitTest Coverage: Failed to collect coverage data.")
-                return 1
+        if os.path.isfile(totalCoverageFile):
+            testCoverageList.append(totalCoverageFile)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            ret = self._merge_coverage_msvc(pool, testCoverageList, totalCoverageFile, workspaceBuild)
+        if ret != 0:
+            logging.error("UnitTest Coverage: Failed to collect coverage data.")
+            return 1
 
         ret = RunCmd(
             "OpenCppCoverage",
-            f"--export_type cobertura:{os.path.join(workspaceBuild, 'coverage.xml')} " +
-            f"--working_dir={workspaceBuild} " +
-            f"--input_coverage={totalCoverageFile}"
+            f"--export_type \"cobertura:{os.path.join(workspaceBuild, 'coverage.xml')}\" " +
+            f'"--working_dir={workspaceBuild}" ' +
+            f'"--input_coverage={totalCoverageFile}"'
             )
         if ret != 0:
             logging.error("UnitTest Coverage: Failed to generate cobertura format xml.")
             return 1
 
         return 0
+
+    def _collect_coverage_msvc(self, testFile, workspace):
+        '''
+        Run a test under OpenCppCoverage and return the exit code. The command is
+        started directly from an argument list, without a shell, so paths with
+        spaces need no quoting.
+        '''
+        try:
+            result = subprocess.run(
+                ["OpenCppCoverage", "--source", workspace,
+                 "--export_type", f"binary:{testFile}.cov", "--", testFile],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+        except OSError as e:
+            logging.error(f"UnitTest Coverage: Failed to run OpenCppCoverage: {e}")
+            return 1
+
+        # Log the output in one block so that it is not interleaved with other tests.
+        output = result.stdout.decode(errors="replace").rstrip()
+        if output:
+            logging.info(output)
+        return result.returncode
+
+    def _find_coverage_files_msvc(self, root):
+        '''
+        Walk root once and return the "*Test*.exe" files and the "*Test*.exe.cov"
+        files found under it.
+        '''
+        exeList = []
+        covList = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                # File names are case-insensitive on Windows.
+                name = filename.lower()
+                if "test" not in name:
+                    continue
+                if name.endswith(".exe"):
+                    exeList.append(os.path.join(dirpath, filename))
+                elif name.endswith(".exe.cov"):
+                    covList.append(os.path.join(dirpath, filename))
+        return exeList, covList
+
+    def _merge_coverage_msvc(self, pool, coverageList, outputFile, workingDir):
+        '''
+        Merge the OpenCppCoverage binary files in coverageList into outputFile.
+
+        The files are merged pairwise, with the merges of each round run concurrently
+        on pool, so N files take log2(N) rounds instead of N serial merges.
+        Intermediate files are removed when done. Nothing is merged, and 0 is
+        returned, when coverageList is empty.
+        '''
+        if not coverageList:
+            return 0
+
+        # RunCmd passes the parameters through a shell, so quote every path.
+        def merge(inputs, output):
+            return RunCmd(
+                "OpenCppCoverage",
+                f'--export_type "binary:{output}" ' +
+                f'"--working_dir={workingDir}" ' +
+                " ".join(f'"--input_coverage={cov}"' for cov in inputs)
+                )
+
+        intermediates = []
+        try:
+            level = 0
+            while len(coverageList) > 2:
+                merged = []
+                futures = []
+                for index in range(0, len(coverageList), 2):
+                    pair = coverageList[index:index + 2]
+                    if len(pair) == 1:
+                        merged.append(pair[0])
+                        continue
+                    output = f"{os.path.splitext(outputFile)[0]}.{level}.{index // 2}.cov"
+                    intermediates.append(output)
+                    futures.append(pool.submit(merge, pair, output))
+                    merged.append(output)
+                if any([future.result() != 0 for future in futures]):
+                    return 1
+                coverageList = merged
+                level += 1
+
+            return merge(coverageList, outputFile)
+        finally:
+            for cov in intermediates:
+                if os.path.isfile(cov):
+                    os.remove(cov)
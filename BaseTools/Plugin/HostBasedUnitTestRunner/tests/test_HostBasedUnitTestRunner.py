@@ -0,0 +1,151 @@
+# @file test_HostBasedUnitTestRunner.py
+#
+# Contains unit tests for the HostBasedUnitTestRunner build plugin.
+#
+# An example of running these tests from the root of the workspace:
+#   python -m unittest discover -s ./BaseTools/Plugin/HostBasedUnitTestRunner/tests -v
+#
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+##
+
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+# Import the build plugin
+test_file = pathlib.Path(__file__)
+sys.path.append(str(test_file.parent.parent))
+
+# flake8 (E402): Ignore flake8 module level import not at top of file
+import HostBasedUnitTestRunner                  # noqa: E402
+
+
+class Test_ParseResultXmls(unittest.TestCase):
+    """
+    Tests for parsing the results XML written by host-based unit tests.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cp = self.temp_dir.name
+        self.test = os.path.join(self.cp, "SampleTest")
+        self.plugin = HostBasedUnitTestRunner.HostBasedUnitTestRunner()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_result(self, name, content):
+        with open(os.path.join(self.cp, name), "w") as f:
+            f.write(content)
+
+    def test_no_results(self):
+        self.assertEqual(self.plugin._parse_result_xmls(self.test, "X64", self.cp), 0)
+
+    def test_cmocka_failures_are_counted(self):
+        self.write_result(
+            "SampleTest.CMOCKA.Group.X64.result.xml",
+            '<testsuites><testsuite name="Group">'
+            '<testcase name="Pass"/>'
+            '<testcase name="Fail"><failure>Assert failed</failure></testcase>'
+            '</testsuite></testsuites>')
+        self.assertEqual(self.plugin._parse_result_xmls(self.test, "X64", self.cp), 1)
+
+    def test_gtest_failures_are_counted(self):
+        self.write_result(
+            "SampleTest.GTEST.X64.result.xml",
+            '<testsuites><testsuite name="Suite">'
+            '<testcase name="A"><failure>1</failure><failure>2</failure></testcase>'
+            '</testsuite></testsuites>')
+        self.assertEqual(self.plugin._parse_result_xmls(self.test, "X64", self.cp), 2)
+
+    def test_other_arch_and_test_results_are_ignored(self):
+        failure = ('<testsuites><testsuite name="Suite"><testcase name="A">'
+                   '<failure>1</failure></testcase></testsuite></testsuites>')
+        self.write_result("SampleTest.GTEST.IA32.result.xml", failure)
+        self.write_result("OtherTest.CMOCKA.Group.X64.result.xml", failure)
+        self.assertEqual(self.plugin._parse_result_xmls(self.test, "X64", self.cp), 0)
+
+    def test_truncated_results_count_as_failure(self):
+        self.write_result(
+            "SampleTest.CMOCKA.Group.X64.result.xml",
+            '<testsuites><testsuite name="Group"><testcase name="A">')
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(self.plugin._parse_result_xmls(self.test, "X64", self.cp), 1)
+
+
+class Test_MergeCoverageMsvc(unittest.TestCase):
+    """
+    Tests for the pairwise merge of OpenCppCoverage binary files.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.temp_dir.name, "coverage.cov")
+        self.plugin = HostBasedUnitTestRunner.HostBasedUnitTestRunner()
+        self.merges = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def fake_run_cmd(self, cmd, parameters, **kwargs):
+        # Record the inputs of each merge and create its output file.
+        self.assertEqual(cmd, "OpenCppCoverage")
+        args = parameters.split('" "')
+        output = args[0].split("binary:", 1)[1].rstrip('"')
+        inputs = [arg.split("--input_coverage=", 1)[1].rstrip('"')
+                  for arg in args if "--input_coverage=" in arg]
+        self.merges.append((inputs, output))
+        open(output, "w").close()
+        return 0
+
+    def merge(self, count):
+        coverage_list = [f"Test{i}.exe.cov" for i in range(count)]
+        with mock.patch.object(HostBasedUnitTestRunner, "RunCmd", side_effect=self.fake_run_cmd), \
+                ThreadPoolExecutor(max_workers=2) as pool:
+            ret = self.plugin._merge_coverage_msvc(pool, coverage_list, self.output, self.temp_dir.name)
+        self.assertEqual(ret, 0)
+        return coverage_list
+
+    def merged_inputs(self):
+        # Expand intermediate files back into the original inputs.
+        sources = {}
+        for inputs, output in self.merges:
+            sources[output] = [cov for i in inputs for cov in sources.pop(i, [i])]
+        return sources
+
+    def assert_merged(self, coverage_list):
+        self.assertEqual(self.merges[-1][1], self.output)
+        self.assertCountEqual(self.merged_inputs()[self.output], coverage_list)
+        for inputs, _ in self.merges:
+            self.assertLessEqual(len(inputs), 2)
+        self.assertEqual(os.listdir(self.temp_dir.name), ["coverage.cov"])
+
+    def test_no_inputs(self):
+        self.merge(0)
+        self.assertEqual(self.merges, [])
+
+    def test_one_input(self):
+        self.assert_merged(self.merge(1))
+        self.assertEqual(len(self.merges), 1)
+
+    def test_two_inputs(self):
+        self.assert_merged(self.merge(2))
+        self.assertEqual(len(self.merges), 1)
+
+    def test_odd_inputs(self):
+        self.assert_merged(self.merge(5))
+        self.assertEqual(len(self.merges), 4)
+
+    def test_merge_failure(self):
+        with mock.patch.object(HostBasedUnitTestRunner, "RunCmd", return_value=1), \
+                ThreadPoolExecutor(max_workers=2) as pool:
+            ret = self.plugin._merge_coverage_msvc(
+                pool, [f"Test{i}.exe.cov" for i in range(3)], self.output, self.temp_dir.name)
+        self.assertEqual(ret, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()